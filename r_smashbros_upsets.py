@@ -4,26 +4,47 @@ import json
 import sys
 import time
 import math
+import abc
+import os
+import threading
 
 ULT_FLAIR = '328ff9f0-9493-11e8-bb38-0eab79b479bc'
 MELEE_FLAIR = '4239bb48-9493-11e8-82ac-0e7a476c5a6c'
 
 SMASH_GG_ENDPOINT = 'https://api.smash.gg/gql/alpha'
 
+DISCORD_MESSAGE_LIMIT = 2000
+SINK_RETRY_TIME = 5
+SINK_MAX_RETRY_TIME = 300
+
 WINNERS = 'Winners'
 LOSERS = 'Losers'
 
 event_slug = ''
 upset_differential = 5
+upset_factor_threshold = 0
+sort_by_upset_factor = False
 top_seed_cutoff = 64
 sleep_time = 300
 
 last_unix_time = 1638594000
 
-DISCLAIMER_STRING = 'This post was made and will be updated approximately every {0} minutes by a bot.\n\nUpsets are defined as a top {1} seed losing to a player seeded {2} or more places below them. Notable sets are defined as a top {1} seed losing to a player seeded less than {2} places below them, or a top {1} seed going last game with a player seeded below them. DQs are noted for top {1} seeds.\n\nCharacters will not be added because I have not yet solved computer vision with regards to Smash.'.format(str(sleep_time//60), top_seed_cutoff, upset_differential)
+def build_disclaimer():
+    if upset_factor_threshold > 0:
+        definition = 'Upsets are defined as a top {0} seed losing to a player with an upset factor of {1} or more, meaning they were projected to place at least {1} placements below them. Notable sets are defined as a top {0} seed losing to a player seeded below them with a lower upset factor'.format(top_seed_cutoff, upset_factor_threshold)
+    else:
+        definition = 'Upsets are defined as a top {0} seed losing to a player seeded {1} or more places below them. Notable sets are defined as a top {0} seed losing to a player seeded less than {1} places below them'.format(top_seed_cutoff, upset_differential)
+
+    sort_str = ' Upsets are sorted by upset factor.' if sort_by_upset_factor else ''
+
+    return 'This post was made and will be updated approximately every {0} minutes by a bot.\n\n{1}, or a top {2} seed going last game with a player seeded below them. DQs are noted for top {2} seeds.{3}\n\nCharacters will not be added because I have not yet solved computer vision with regards to Smash.'.format(str(sleep_time//60), definition, top_seed_cutoff, sort_str)
+
+DISCLAIMER_STRING = build_disclaimer()
 
 header = ''
 
+placement_table = [0]
+
 def ordinal(num):
     if num % 100 >= 11 and num % 100 <= 13:
         return str(num) + "th"
@@ -35,6 +56,28 @@ def ordinal(num):
         return str(num) + "rd"
     return str(num) + "th"
 
+def build_placement_table(num_entrants):
+    # double elimination placements go 1, 2, 3, 4, 5, 7, 9, 13, 17, 25, ...
+    placements = [1, 2, 3, 4]
+    bracket_size = 4
+    while placements[-1] <= num_entrants:
+        placements.append(bracket_size + 1)
+        placements.append(bracket_size + bracket_size // 2 + 1)
+        bracket_size *= 2
+
+    # table[seed] is the index of the placement that seed is projected to get
+    table = [0] * (num_entrants + 1)
+    tier = 0
+    for seed in range(1, num_entrants + 1):
+        while placements[tier + 1] <= seed:
+            tier += 1
+        table[seed] = tier
+
+    return table
+
+def projected_tier(seed):
+    return placement_table[min(seed, len(placement_table) - 1)]
+
 def redditify_string(string):
     return string.replace('\\', '\\\\').replace('^', '\\^').replace('_', '\\_').replace('*', '\\*').replace('~', '\\~').replace('>', '\\>').replace('#', '\\#').replace('|', 'l')
 
@@ -43,6 +86,7 @@ def embolden(string):
 
 class Entrant:
     def __init__(self, name, seed):
+        self.raw_name = name
         self.name = redditify_string(name)
         self.seed = seed
 
@@ -134,6 +178,24 @@ class Set:
         else:
             return self.g1
 
+    def get_upset_factor(self):
+        return projected_tier(self.get_winner_seed()) - projected_tier(self.get_loser_seed())
+
+    def to_dict(self):
+        return {
+            'winner': self.get_winner().raw_name,
+            'winner_seed': self.get_winner_seed(),
+            'winner_score': self.get_winner_score(),
+            'loser': self.get_loser().raw_name,
+            'loser_seed': self.get_loser_seed(),
+            'loser_score': self.get_loser_score(),
+            'is_losers': self.is_losers,
+            'loser_placement': self.loser_placement,
+            'upset_factor': self.get_upset_factor(),
+            'phase': self.phase,
+            'timestamp': self.timestamp
+        }
+
 def send_request(query, vars):
     json_payload = {
         "query": query,
@@ -462,6 +524,8 @@ def get_tournament_name():
     return event['tournament']['name'], event['name']
 
 def is_upset(set_data):
+    if upset_factor_threshold > 0:
+        return set_data.get_upset_factor() >= upset_factor_threshold
     return set_data.get_winner_seed() - set_data.get_loser_seed() >= upset_differential
 
 def is_dq(set_data):
@@ -473,7 +537,7 @@ def high_enough_seed(set_data):
 def is_notable(set_data):
     if set_data.get_winner_seed() > top_seed_cutoff:
         return False
-    if set_data.get_winner_seed() - set_data.get_loser_seed() < upset_differential:
+    if not is_upset(set_data):
         if set_data.get_winner_seed() > set_data.get_loser_seed():
             return True 
         try:
@@ -482,8 +546,9 @@ def is_notable(set_data):
             return False
     return False
 
-def list_sets(sets, sets_data):
+def list_sets(sets, sets_data, sort_by_factor=False, for_discord=False):
     body_str = ''
+    show_factor = sort_by_factor or upset_factor_threshold > 0
     winners_sets = []
     losers_sets = []
 
@@ -505,23 +570,36 @@ def list_sets(sets, sets_data):
         if len(winners_upsets) == 0 and len(losers_upsets) == 0:
             continue
 
+        if sort_by_factor:
+            # stable sort, so sets with the same factor stay in timestamp order
+            winners_upsets.sort(key=lambda upset: upset.get_upset_factor(), reverse=True)
+            losers_upsets.sort(key=lambda upset: upset.get_upset_factor(), reverse=True)
+
+        # discord needs a space after the #s, and its top level heading is taken by the section
+        heading = '## ' if for_discord else '#'
+        subheading = '### ' if for_discord else '###'
+
         # title
-        body_str += '#' + phase
+        body_str += heading + phase
         body_str += '\n\n'
 
         if len(winners_upsets) != 0:
-            body_str += '###Winners'
+            body_str += subheading + 'Winners'
             body_str += '\n'
             for upset in winners_upsets:
                 body_str += str(upset)
+                if show_factor:
+                    body_str += ' [upset factor ' + str(upset.get_upset_factor()) + ']'
                 body_str += '  \n'
             body_str += '\n'
 
         if len(losers_upsets) != 0:
-            body_str += '###Losers'
+            body_str += subheading + 'Losers'
             body_str += '\n'
             for upset in losers_upsets:
                 body_str += str(upset)
+                if show_factor:
+                    body_str += ' [upset factor ' + str(upset.get_upset_factor()) + ']'
                 body_str += '  \n'
             body_str += '\n'
 
@@ -553,26 +631,187 @@ def generate_dqs(winners_dqs_ids, losers_dqs_ids, sets_data):
     return body_str
 
 
-def generate_reddit_body(upsets, notables, winners_dqs, losers_dqs, sets_data):
-    body_str = DISCLAIMER_STRING + '\n\n'
+def generate_reddit_body(upsets, notables, winners_dqs, losers_dqs, sets_data, include_disclaimer=True, for_discord=False):
+    body_str = ''
+    if include_disclaimer:
+        body_str += DISCLAIMER_STRING + '\n\n'
+
+    # discord doesn't render horizontal rules
+    section_str = '# ' if for_discord else '---\n\n#'
 
     if len(upsets) != 0:
-        body_str += '---\n\n#Upsets\n\n'
+        body_str += section_str + 'Upsets\n\n'
 
-        body_str += list_sets(upsets, sets_data)
+        body_str += list_sets(upsets, sets_data, sort_by_upset_factor, for_discord)
 
     if len(notables) != 0:
-        body_str += '---\n\n#Notable Sets\n\n'
+        body_str += section_str + 'Notable Sets\n\n'
 
-        body_str += list_sets(notables, sets_data)
+        body_str += list_sets(notables, sets_data, for_discord=for_discord)
 
     if len(winners_dqs) != 0 or len(losers_dqs) != 0:
-        body_str += '---\n\n#DQs\n\n'
+        body_str += section_str + 'DQs\n\n'
 
         body_str += generate_dqs(winners_dqs, losers_dqs, sets_data)
 
     return body_str
 
+def split_message(body_str, limit):
+    # split on line boundaries so no set gets cut in half
+    messages = []
+    message = ''
+    for line in body_str.splitlines(True):
+        if len(message) + len(line) > limit and message != '':
+            messages.append(message)
+            message = ''
+        while len(line) > limit:
+            messages.append(line[:limit])
+            line = line[limit:]
+        message += line
+    messages.append(message)
+
+    return tuple(message.strip() for message in messages if message.strip() != '')
+
+class Sink(abc.ABC):
+    def __init__(self, name, min_interval=0):
+        self.name = name
+        self.min_interval = min_interval
+        self.last_content = None
+        self.last_publish_time = 0
+        self.retry_time = SINK_RETRY_TIME
+        self.pending = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def render(self, upsets, notables, winners_dqs, losers_dqs, sets_data):
+        return generate_reddit_body(upsets, notables, winners_dqs, losers_dqs, sets_data)
+
+    @abc.abstractmethod
+    def write(self, content):
+        pass
+
+    def submit(self, content):
+        # only the newest content is kept, so a slow sink skips stale updates
+        with self.condition:
+            self.pending = content
+            self.condition.notify()
+
+    def take_pending(self):
+        with self.condition:
+            content = self.pending
+            self.pending = None
+            return content
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+
+            wait_time = self.last_publish_time + self.min_interval - time.time()
+            if wait_time > 0:
+                time.sleep(wait_time)
+
+            content = self.take_pending()
+            if content is None or content == self.last_content:
+                continue
+
+            try:
+                self.write(content)
+            except Exception as e:
+                # put the content back unless something newer has already arrived
+                with self.condition:
+                    if self.pending is None:
+                        self.pending = content
+                print('failed to update {}, retrying in {} seconds: {}'.format(self.name, self.retry_time, e))
+                time.sleep(self.retry_time)
+                self.retry_time = min(self.retry_time * 2, SINK_MAX_RETRY_TIME)
+                continue
+
+            self.retry_time = SINK_RETRY_TIME
+            self.last_content = content
+            self.last_publish_time = time.time()
+            print('updated {}'.format(self.name))
+
+class RedditSink(Sink):
+    def __init__(self, post, min_interval=0):
+        super().__init__('reddit post ' + post.id, min_interval)
+        self.post = post
+
+    def write(self, content):
+        self.post.edit(content)
+
+class DiscordSink(Sink):
+    def __init__(self, webhook_url, message_ids=None, min_interval=5):
+        super().__init__('discord webhook', min_interval)
+        self.webhook_url = webhook_url.rstrip('/')
+        self.message_ids = list(message_ids) if message_ids else []
+        # content of existing messages is unknown, so they all get edited on the first write
+        self.sent_messages = [None] * len(self.message_ids)
+
+    def render(self, upsets, notables, winners_dqs, losers_dqs, sets_data):
+        body_str = generate_reddit_body(upsets, notables, winners_dqs, losers_dqs, sets_data, include_disclaimer=False, for_discord=True)
+        return split_message(body_str, DISCORD_MESSAGE_LIMIT)
+
+    def payload(self, message):
+        # player tags come straight from start.gg, so never let them ping anyone
+        return {"content": message, "allowed_mentions": {"parse": []}}
+
+    def write(self, content):
+        # one webhook message per chunk, only touching the ones that changed
+        for i, message in enumerate(content):
+            if i < len(self.message_ids):
+                if self.sent_messages[i] != message:
+                    response = requests.patch(self.webhook_url + '/messages/' + self.message_ids[i], json=self.payload(message))
+                    response.raise_for_status()
+                    self.sent_messages[i] = message
+            else:
+                response = requests.post(self.webhook_url + '?wait=true', json=self.payload(message))
+                response.raise_for_status()
+                self.message_ids.append(response.json()['id'])
+                self.sent_messages.append(message)
+                print('posted discord message with id {}'.format(self.message_ids[-1]))
+
+        while len(self.message_ids) > len(content):
+            response = requests.delete(self.webhook_url + '/messages/' + self.message_ids[-1])
+            response.raise_for_status()
+            self.message_ids.pop()
+            self.sent_messages.pop()
+
+class FileSink(Sink):
+    def __init__(self, label, path, min_interval=0):
+        super().__init__(label + ' ' + path, min_interval)
+        self.path = path
+
+    def write(self, content):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(temp_path, self.path)
+
+class MarkdownFileSink(FileSink):
+    def __init__(self, path, min_interval=0):
+        super().__init__('markdown file', path, min_interval)
+
+class JsonFileSink(FileSink):
+    def __init__(self, path, min_interval=0):
+        super().__init__('json file', path, min_interval)
+
+    def render(self, upsets, notables, winners_dqs, losers_dqs, sets_data):
+        return json.dumps({
+            'upsets': [sets_data[set_id].to_dict() for set_id in upsets],
+            'notables': [sets_data[set_id].to_dict() for set_id in notables],
+            'winners_dqs': [sets_data[set_id].to_dict() for set_id in winners_dqs],
+            'losers_dqs': [sets_data[set_id].to_dict() for set_id in losers_dqs]
+        }, indent=4)
+
+def publish_sets(sinks, upsets, notables, winners_dqs, losers_dqs, sets_data):
+    for sink in sinks:
+        sink.submit(sink.render(upsets, notables, winners_dqs, losers_dqs, sets_data))
+
 
 if __name__ == '__main__':
     event_slug = input('input event slug: ')
@@ -584,8 +823,6 @@ if __name__ == '__main__':
         print('you must input a number!')
         sys.exit()
 
-    DISCLAIMER_STRING = 'This post was made and will be updated approximately every {0} minutes by a bot.\n\nUpsets are defined as a top {1} seed losing to a player seeded {2} or more places below them. Notable sets are defined as a top {1} seed losing to a player seeded less than {2} places below them, or a top {1} seed going last game with a player seeded below them. DQs are noted for top {1} seeds.\n\nCharacters will not be added because I have not yet solved computer vision with regards to Smash.'.format(str(sleep_time//60), top_seed_cutoff, upset_differential)
-
     game = ''
     while game != 'U' and game != 'M':
         game = input('input U for Ultimate, M for Melee: ').upper()
@@ -604,7 +841,29 @@ if __name__ == '__main__':
 
     seeds = get_seeds()
 
+    placement_table = build_placement_table(max([entrant.seed for entrant in seeds.values()] + [len(seeds)]))
+
     post_id = input('Enter existing post id (enter none if there isn\'t one): ')
+    discord_webhook = input('Enter discord webhook url (enter none if there isn\'t one): ')
+    discord_message_ids = 'none'
+    if discord_webhook != 'none':
+        discord_message_ids = input('Enter existing discord message ids separated by commas (enter none if there aren\'t any): ')
+    markdown_path = input('Enter markdown output file (enter none if there isn\'t one): ')
+    json_path = input('Enter json output file (enter none if there isn\'t one): ')
+
+    try:
+        upset_factor_threshold = int(input('upset factor that counts as an upset (0 to use seed differential): '))
+    except ValueError:
+        print('you must input a number!')
+        sys.exit()
+
+    sort_order = ''
+    while sort_order != 'Y' and sort_order != 'N':
+        sort_order = input('sort upsets by upset factor? (Y/N): ').upper()
+
+    sort_by_upset_factor = sort_order == 'Y'
+
+    DISCLAIMER_STRING = build_disclaimer()
 
     time.sleep(70) # refresh rate limit
 
@@ -629,6 +888,18 @@ if __name__ == '__main__':
         post = praw.models.Submission(reddit, post_id)
         print('editing post in /r/{} with id {}'.format(post.subreddit.display_name, post.id))
 
+    sinks = [RedditSink(post)]
+    if discord_webhook != 'none':
+        message_ids = [] if discord_message_ids == 'none' else [message_id.strip() for message_id in discord_message_ids.split(',') if message_id.strip() != '']
+        sinks.append(DiscordSink(discord_webhook, message_ids))
+    if markdown_path != 'none':
+        sinks.append(MarkdownFileSink(markdown_path))
+    if json_path != 'none':
+        sinks.append(JsonFileSink(json_path))
+
+    for sink in sinks:
+        sink.start()
+
     while True:
         standings = get_final_standings()
 
@@ -673,9 +944,7 @@ if __name__ == '__main__':
                 winners_dqs.sort(key=lambda set_id: sets_data[set_id].timestamp)
                 losers_dqs.sort(key=lambda set_id: sets_data[set_id].timestamp)
 
-            post.edit(generate_reddit_body(upsets, notables, winners_dqs, losers_dqs, sets_data))
-
-            print('updated post')
+            publish_sets(sinks, upsets, notables, winners_dqs, losers_dqs, sets_data)
 
         time.sleep(sleep_time)
 